@@ -9,10 +9,12 @@ This script generates PNG thumbnails of images in various sizes
 output directory (should be `~/.cache/thumbnails/`).
 
 - `Multiprocessing` to execute processing in parallel.
-- `Pillow` library for image processing (resize).
+- `Pillow` library for image processing (resize), or `Pillow-SIMD` as a drop-in.
+- `pyvips` (optional) to decode and shrink non-RAW images with less memory.
 - `Pillow.ImageDraw` to add a label to the thumbnail indicating the original file format.
 - `Subprocess` to extract preview images from RAW files using `ExifTool`.
 - `Subprocess` to handle rotation from Exif files using `ExifTool`.
+  (one `-stay_open` ExifTool process per worker, reused for every RAW file)
 
 The input can be either a file or a directory (which will be searched recursively).
 
@@ -25,94 +27,197 @@ $ gsettings set org.gnome.nautilus.preferences thumbnail-limit 536870912000 (~50
 $ gsettings set org.gnome.desktop.thumbnail-cache maximum-age 365
 """
 
+import base64
+import functools
 import hashlib
+import json
 import logging
 import multiprocessing
+import multiprocessing.util
+import os
 import subprocess
 import io
 
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from typing import List, Optional, Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
 
-from PIL import Image, ImageOps, ImageDraw, ImageFont
+import PIL
+from PIL import Image, ImageOps, ImageDraw, ImageFont, JpegImagePlugin
 from PIL.PngImagePlugin import PngInfo
 
 from tqdm import tqdm
 
+try:
+    import pyvips
+
+    logging.getLogger("pyvips").setLevel(logging.WARNING)
+except (ImportError, OSError):  # OSError: pyvips without the libvips library
+    pyvips = None
+
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
-SUPPORTED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".cr2", ".cr3", ".arw"}
+SUPPORTED_EXTENSIONS = (".jpg", ".jpeg", ".png", ".cr2", ".cr3", ".arw")
+PREVIEW_TAGS = ("JpgFromRaw", "PreviewImage", "ThumbnailImage")
+ALPHA_BACKGROUND = (255, 255, 255)  # transparent areas are flattened onto this
+PNG_COMPRESS_LEVEL = 1  # zlib level: much faster than the default 6, slightly bigger
 FONT = "/usr/share/fonts/truetype/jetbrains-mono/JetBrainsMono-Bold.ttf"
 THUMBNAIL_CONFIG = {
     "normal": {
         "size": (128, 128),
         "font_size": 20,
+        "palette": True,
     },
     "large": {
         "size": (256, 256),
         "font_size": 30,
+        "palette": True,
     },
     "x-large": {
         "size": (512, 512),
         "font_size": 40,
+        "palette": True,
     },
     # "xx-large": {
     #     "size": (1024, 1024),
     #     "font_size": 100,
+    #     "palette": False,
     # },
 }
+MAX_THUMBNAIL_SIZE = max(max(config["size"]) for config in THUMBNAIL_CONFIG.values())
 
 from PIL import ImageDraw, ImageFont
 
 
-def add_raw_label(image: Image.Image, label: str, text: str) -> Image.Image:
-    """Add a label to the image indicating the original file format."""
-    draw = ImageDraw.Draw(image)
-    size = THUMBNAIL_CONFIG[label]["font_size"]
-    x, y = 0, 0
+@functools.lru_cache(maxsize=8)
+def _font(size: int) -> ImageFont.FreeTypeFont:
+    """Load the label font once per size and process."""
+    return ImageFont.truetype(FONT, size)
+
 
-    font = ImageFont.truetype(FONT, size)
+@functools.lru_cache(maxsize=32)
+def _label_sprite(label: str, text: str) -> Image.Image:
+    """Render the label box once per thumbnail size and text."""
+    size = THUMBNAIL_CONFIG[label]["font_size"]
+    font = _font(size)
 
-    text_bbox = draw.textbbox((x, y), text, font=font)
+    text_bbox = font.getbbox(text)
     text_width = text_bbox[2] - text_bbox[0]
     text_height = text_bbox[3] - text_bbox[1]
     box_padding = int(size * 0.5)
-    draw.rectangle(
-        [
-            x - box_padding,
-            y - box_padding,
-            x + text_width + box_padding,
-            y + text_height + box_padding,
-        ],
-        fill="black",
+    # The box is anchored at the top-left corner, only its padding
+    # towards the bottom-right is visible.
+    sprite = Image.new(
+        "RGB", (text_width + box_padding + 1, text_height + box_padding + 1), "black"
     )
-    draw.text((x, y), text, fill="white", font=font)
+    ImageDraw.Draw(sprite).text((0, 0), text, fill="white", font=font)
+    return sprite
+
+
+def add_raw_label(image: Image.Image, label: str, text: str) -> Image.Image:
+    """Add a label to the image indicating the original file format."""
+    image.paste(_label_sprite(label, text), (0, 0))
     return image
 
 
-def extract_cr3_preview(image_path: Path, tag: str = "PreviewImage") -> io.BytesIO:
-    """Extract preview image from RAW file using exiftool."""
-    logging.info(f"Extracting preview from RAW: {image_path}")
-    result = subprocess.run(
-        ["exiftool", f"-{tag}", "-b", str(image_path)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=False,
-    )
-    if result.returncode != 0 or not result.stdout:
-        raise RuntimeError(
-            f"ExifTool failed on {image_path}:\n{result.stderr.decode().strip()}"
+class ExifTool:
+    """Persistent `exiftool -stay_open` process, reading arguments from stdin."""
+
+    READY = b"{ready}\n"
+
+    def __init__(self) -> None:
+        self.process = subprocess.Popen(
+            ["exiftool", "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
         )
 
-    orient_proc = subprocess.run(
-        ["exiftool", "-Orientation", "-s3", str(image_path)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=False,
-        text=True,
+    def execute(self, *args: str) -> bytes:
+        """Run one exiftool command and return its output.
+        On any failure the process is killed, so it is not reused."""
+        # Paths are passed as bytes, like argv, to keep non-UTF-8 names intact.
+        command = b"\n".join(os.fsencode(arg) for arg in args) + b"\n-execute\n"
+        try:
+            self.process.stdin.write(command)
+            self.process.stdin.flush()
+
+            output = bytearray()
+            fd = self.process.stdout.fileno()
+            while not output.endswith(self.READY):
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    raise RuntimeError("ExifTool exited unexpectedly.")
+                output += chunk
+        except BaseException:
+            self.process.kill()
+            self.process.wait()
+            raise
+        return bytes(output[: -len(self.READY)])
+
+    def close(self) -> None:
+        """Ask exiftool to exit and wait for it."""
+        if self.process.poll() is None:
+            self.process.stdin.write(b"-stay_open\nFalse\n")
+            self.process.stdin.close()
+            self.process.wait()
+
+
+_exiftool: Optional[ExifTool] = None
+
+
+def get_exiftool() -> ExifTool:
+    """Return the exiftool process of the current worker, starting it if needed."""
+    global _exiftool
+    if _exiftool is not None and _exiftool.process.poll() is not None:
+        _exiftool = None
+    if _exiftool is None:
+        _exiftool = ExifTool()
+        # Unlike atexit, runs when a pool worker process exits.
+        multiprocessing.util.Finalize(_exiftool, _exiftool.close, exitpriority=10)
+    return _exiftool
+
+
+def extract_cr3_preview(
+    image_path: Path, tags: Sequence[str] = PREVIEW_TAGS
+) -> Image.Image:
+    """Extract the smallest embedded preview covering the largest thumbnail size
+    from RAW file using exiftool.
+    The returned image is already rotated according to the RAW orientation."""
+    logging.info(f"Extracting preview from RAW: {image_path}")
+    output = get_exiftool().execute(
+        "-json",
+        "-b",
+        "-fast2",
+        *(f"-{tag}" for tag in tags),
+        "-Orientation",
+        str(image_path),
+    )
+    try:
+        metadata = json.loads(output)[0]
+    except (ValueError, IndexError):
+        metadata = {}
+
+    # With -json, binary values are returned base64-encoded.
+    previews = [
+        base64.b64decode(value[len("base64:") :])
+        for value in (metadata.get(tag) for tag in tags)
+        if isinstance(value, str) and value.startswith("base64:")
+    ]
+    if not previews:
+        raise RuntimeError(f"ExifTool found no preview in {image_path}")
+
+    # Image.open only reads the header: pick the smallest preview that still
+    # covers the largest thumbnail, or the largest one if none does.
+    images = sorted(
+        (Image.open(io.BytesIO(preview)) for preview in previews),
+        key=lambda image: image.width * image.height,
     )
-    orientation_str = orient_proc.stdout.strip()
+    img = next(
+        (image for image in images if max(image.size) >= MAX_THUMBNAIL_SIZE),
+        images[-1],
+    )
+    orientation_str = str(metadata.get("Orientation", ""))
 
     rotate_map = {
         "Rotate 90 CW": -90,
@@ -120,102 +225,220 @@ def extract_cr3_preview(image_path: Path, tag: str = "PreviewImage") -> io.Bytes
         "Rotate 90 CCW": 90,
         "Rotate 180": 180,
     }
-    img = Image.open(io.BytesIO(result.stdout))
+    img.draft("RGB", (MAX_THUMBNAIL_SIZE, MAX_THUMBNAIL_SIZE))
     rotation = rotate_map.get(orientation_str, 0)
     if rotation:
         img = img.rotate(rotation, expand=True)
 
-    img_bytes_io = io.BytesIO()
-    img.save(img_bytes_io, format="JPEG")
+    return img
+
+
+def fit_size(size: Tuple[int, int], box: Tuple[int, int]) -> Tuple[int, int]:
+    """Largest size fitting in the box with the same aspect ratio, never upscaling."""
+    width, height = size
+    scale = min(box[0] / width, box[1] / height, 1.0)
+    return max(1, int(width * scale)), max(1, int(height * scale))
 
-    return img_bytes_io
+
+def load_with_vips(image_path: Path) -> Image.Image:
+    """Decode and shrink an image with libvips, then hand it over to Pillow.
+    libvips uses shrink-on-load and streams the decode, so the full-size
+    image is never held in memory. EXIF orientation is applied."""
+    vips_img = pyvips.Image.thumbnail(str(image_path), MAX_THUMBNAIL_SIZE, size="down")
+    vips_img = vips_img.colourspace("srgb")
+    if vips_img.hasalpha():
+        vips_img = vips_img.flatten(background=list(ALPHA_BACKGROUND))
+    return Image.frombytes(
+        "RGB", (vips_img.width, vips_img.height), vips_img.write_to_memory()
+    )
+
+
+def save_thumbnail(
+    thumb: Image.Image,
+    label: str,
+    out_path: Path,
+    file_extension: str,
+    metadata: PngInfo,
+) -> None:
+    """Label one thumbnail size and save it as PNG."""
+    # Every size is derived before saving starts, so labeling in place is safe.
+    if file_extension in SUPPORTED_EXTENSIONS:
+        thumb = add_raw_label(thumb, label, file_extension)
+    # An adaptive 256-color palette is hard to tell apart at these sizes
+    # and stores one byte per pixel instead of three.
+    if THUMBNAIL_CONFIG[label]["palette"] and thumb.mode == "RGB":
+        thumb = thumb.convert("P", palette=Image.ADAPTIVE, colors=256)
+    thumb.save(
+        out_path,
+        format="PNG",
+        pnginfo=metadata,
+        compress_level=PNG_COMPRESS_LEVEL,
+    )
+
+
+def thumbnail_name(image_path: Path) -> Tuple[str, str]:
+    """Return the URI of an image and the filename of its thumbnails."""
+    uri = image_path.absolute().as_uri()
+    hash_hex = hashlib.md5(uri.encode("utf-8"), usedforsecurity=False).hexdigest()
+    return uri, f"{hash_hex}.png"
+
+
+def thumbnails_exist(output_base: Path, out_filename: str) -> bool:
+    """Check whether every thumbnail size already exists."""
+    return all(
+        os.path.exists(os.path.join(output_base, label, out_filename))
+        for label in THUMBNAIL_CONFIG
+    )
 
 
 def generate_thumbnails(
-    image_path: Path, output_base: Path, overwrite=False
+    image_path: Path, uri: str, out_filename: str, output_base: Path
 ) -> Optional[str]:
     """Generate multiple size thumbnails for one image.
-    If one size is missing, it will generate all sizes.
-    overwrite (bool): If True, overwrite existing thumbnails."""
-
-    uri = image_path.resolve().as_uri()
-    hash_hex = hashlib.md5(uri.encode("utf-8")).hexdigest()
-    out_filename = f"{hash_hex}.png"
-
-    if not overwrite:
-        all_exist = True
-        for label in THUMBNAIL_CONFIG.keys():
-            out_dir = output_base / label
-            out_path = out_dir / out_filename
-            if not out_path.exists():
-                print(f"Thumbnail does not exist: {uri} {out_path}")
-                all_exist = False
-                break
-        if all_exist:
-            logging.info(f"All thumbnails already exist for: {image_path}")
-            return None
+    All sizes are (re)generated, existing thumbnails are overwritten."""
 
     try:
+        # Taken before decoding: a file modified meanwhile is seen as stale later.
+        mtime = str(int(image_path.stat().st_mtime))
+
+        # RAW previews and libvips come back already rotated: the preview's own
+        # EXIF must not be applied on top of the RAW orientation.
         if image_path.suffix.lower() in {".cr3", ".cr2", ".arw"}:
-            img = Image.open(extract_cr3_preview(image_path))
+            img = extract_cr3_preview(image_path)
+        elif pyvips is not None:
+            img = load_with_vips(image_path)
         else:
             img = Image.open(image_path)
 
-        img = ImageOps.exif_transpose(img)
+            # Let libjpeg decode at a reduced scale (1/2, 1/4, 1/8) when possible.
+            # Camera JPEGs with a multi-picture header open as MPO, a JPEG subclass.
+            if isinstance(img, JpegImagePlugin.JpegImageFile):
+                img.draft("RGB", (MAX_THUMBNAIL_SIZE, MAX_THUMBNAIL_SIZE))
+
+            img = ImageOps.exif_transpose(img)
+
+        # Pillow resamples band by band: drop alpha (and CMYK, 16-bit...) early.
+        # Alpha is flattened onto the same background as in load_with_vips.
+        if img.has_transparency_data:
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, ALPHA_BACKGROUND)
+            img.paste(rgba, mask=rgba)
+        elif img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
 
         metadata = PngInfo()
         metadata.add_text("Thumb::URI", uri)
-        metadata.add_text("Thumb::MTime", str(int(image_path.stat().st_mtime)))
+        metadata.add_text("Thumb::MTime", mtime)
         metadata.add_text("Software", "make-thumbnail")
 
-        for label, config in THUMBNAIL_CONFIG.items():
-            size = config["size"]
-            thumb = img.copy()
-            thumb.thumbnail(size, Image.LANCZOS)
-
-            out_dir = output_base / label
-            out_dir.mkdir(parents=True, exist_ok=True)
-            out_path = out_dir / out_filename
-            thumb.save(out_path, format="PNG", pnginfo=metadata)
-
-            file_extension = image_path.suffix.lower()
-            if file_extension in SUPPORTED_EXTENSIONS:
-                thumb = add_raw_label(thumb, label, file_extension)
-                thumb.save(out_path, format="PNG", pnginfo=metadata)
+        # Largest size first: each smaller size is downscaled from the previous
+        # (unlabeled) thumbnail, only the first step pays for LANCZOS on the source.
+        thumbs = {}
+        source = img
+        for label, config in sorted(
+            THUMBNAIL_CONFIG.items(), key=lambda item: item[1]["size"], reverse=True
+        ):
+            box = config["size"]
+            # reducing_gap: shrink with a cheap integer reduce first, as thumbnail().
+            if not thumbs:
+                source = source.resize(
+                    fit_size(source.size, box), Image.LANCZOS, reducing_gap=2.0
+                )
+            elif min(box[0] / source.width, box[1] / source.height) == 0.5:
+                # Exact halving (512 -> 256 -> 128): integer box reduction.
+                source = source.reduce(2)
+            else:
+                source = source.resize(
+                    fit_size(source.size, box), Image.HAMMING, reducing_gap=2.0
+                )
+            thumbs[label] = source
+
+        # Pillow releases the GIL while drawing, quantizing and encoding PNGs.
+        file_extension = image_path.suffix.lower()
+        with ThreadPoolExecutor(max_workers=len(thumbs)) as executor:
+            futures = [
+                executor.submit(
+                    save_thumbnail,
+                    thumb,
+                    label,
+                    output_base / label / out_filename,
+                    file_extension,
+                    metadata,
+                )
+                for label, thumb in thumbs.items()
+            ]
+            for future in futures:
+                future.result()
 
     except Exception as e:
         return f"{image_path}: {e}"
     return None
 
 
+def _walk(directory: str) -> Iterator[Path]:
+    """Yield supported image files below a directory, without following symlinks."""
+    try:
+        entries = os.scandir(directory)
+    except OSError as e:
+        logging.warning(f"Skipping unreadable directory: {e}")
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path)
+            elif entry.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                yield Path(entry.path)
+
+
 def collect_image_paths(input_path: Path) -> List[Path]:
     """Recursively collect image files from a path."""
     if input_path.is_file():
         return [input_path] if input_path.suffix.lower() in SUPPORTED_EXTENSIONS else []
     elif input_path.is_dir():
-        return [
-            p for p in input_path.rglob("*") if p.suffix.lower() in SUPPORTED_EXTENSIONS
-        ]
+        return list(_walk(str(input_path)))
     else:
         raise ValueError("Input must be a file or directory.")
 
 
+def _warmup(font: str) -> None:
+    """Prepare a worker process once, before it receives any image."""
+    global FONT
+    FONT = font
+    # Thumbnails are only ever generated from local, trusted files.
+    Image.MAX_IMAGE_PIXELS = None
+    Image.init()
+    try:
+        for config in THUMBNAIL_CONFIG.values():
+            _font(config["font_size"])
+    except OSError:
+        pass  # Reported per image by add_raw_label.
+
+
 def process_images(
-    image_paths: List[Path], output_dir: Path, num_workers: int, overwrite: bool = False
+    jobs: List[Tuple[Path, str, str]], output_dir: Path, num_workers: int
 ) -> List[str]:
-    """Prepare threads to generate thumbnails in parallel."""
+    """Prepare threads to generate thumbnails in parallel.
+    Each job is an (image path, URI, thumbnail filename) tuple."""
     errors = []
-    with ProcessPoolExecutor(max_workers=num_workers) as executor:
-        futures = {
-            executor.submit(generate_thumbnails, path, output_dir, overwrite): path
-            for path in image_paths
-        }
-        for future in tqdm(
-            as_completed(futures),
-            total=len(futures),
+    image_paths, uris, out_filenames = zip(*jobs)
+    work = functools.partial(generate_thumbnails, output_base=output_dir)
+    # Hand out paths in chunks to keep pickling and future bookkeeping low.
+    chunksize = max(1, len(jobs) // (num_workers * 8))
+    # forkserver workers start from a clean, preloaded process instead of
+    # sharing (and copying on write) the memory of the driver.
+    start_methods = multiprocessing.get_all_start_methods()
+    start_method = "forkserver" if "forkserver" in start_methods else None
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context(start_method),
+        initializer=_warmup,
+        initargs=(FONT,),
+    ) as executor:
+        for error in tqdm(
+            executor.map(work, image_paths, uris, out_filenames, chunksize=chunksize),
+            total=len(jobs),
             desc="Generating thumbnails",
         ):
-            error = future.result()
             if error:
                 errors.append(error)
     return errors
@@ -227,10 +450,15 @@ def main(
     num_workers: Optional[int] = None,
     overwrite: bool = False,
 ) -> None:
-    input_path = Path(input_path)
+    # URIs are built from the path as given, symlinks are never resolved (as GIO
+    # does). abspath only makes it absolute and collapses "..".
+    input_path = Path(os.path.abspath(input_path))
     output_dir = Path(output_dir)
     num_workers = num_workers or multiprocessing.cpu_count()
 
+    if ".post" in PIL.__version__:
+        logging.info(f"Using Pillow-SIMD {PIL.__version__}")
+
     try:
         image_paths = collect_image_paths(input_path)
     except ValueError as ve:
@@ -241,7 +469,22 @@ def main(
         logging.warning("No supported image files found.")
         return
 
-    errors = process_images(image_paths, output_dir, num_workers, overwrite=overwrite)
+    # Skip cached images here, before anything is sent to a worker.
+    jobs = [(path, *thumbnail_name(path)) for path in image_paths]
+    if not overwrite:
+        jobs = [job for job in jobs if not thumbnails_exist(output_dir, job[2])]
+        if len(jobs) < len(image_paths):
+            logging.info(
+                f"Thumbnails already exist for {len(image_paths) - len(jobs)} images."
+            )
+    if not jobs:
+        logging.info("All thumbnails are up to date.")
+        return
+
+    for label in THUMBNAIL_CONFIG:
+        (output_dir / label).mkdir(parents=True, exist_ok=True)
+
+    errors = process_images(jobs, output_dir, num_workers)
 
     if errors:
         logging.warning("Some images failed to process:")
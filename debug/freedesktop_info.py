@@ -1,7 +1,7 @@
 #!/usr/bin/python3
 import os
 import sys
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import gi
 gi.require_version("GnomeDesktop", "4.0")
@@ -52,9 +52,17 @@ def make_thumbnail(factory, filename):
 
 
 def thumbnail_folder(factory, folder):
+    futures = {}
     for dirpath, dirnames, filenames in os.walk(folder):
         for filename in filenames:
-            executor.submit(make_thumbnail(factory, os.path.join(dirpath, filename)))
+            path = os.path.join(dirpath, filename)
+            futures[executor.submit(make_thumbnail, factory, path)] = path
+
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception as e:
+            print(f"ERROR {e}   {futures[future]}")
 
 
 def main(argv):